@@ -1,10 +1,21 @@
+import asyncio
+import aiohttp
+import functools
+import hashlib
+import orjson
+import shelve
 import requests
-from bs4 import BeautifulSoup
-import urllib.request
-import urllib.error
-import json
+import tiktoken
+import io
+from concurrent.futures import ThreadPoolExecutor
+from html import escape
+from itertools import accumulate
+from lxml import etree
 import os
+import shutil
 import ssl
+import subprocess
+import tempfile
 from dotenv import load_dotenv
 from openai import OpenAI
 
@@ -19,6 +30,12 @@ AZURE_MODEL_ENDPOINT = os.getenv("AZURE_MODEL_ENDPOINT")
 if not AZURE_API_KEY or not OPENAI_API_KEY or not AZURE_MODEL_ENDPOINT:
     raise Exception("Missing required environment variables. Check your .env file.")
 
+# Maximum number of batches sent to the Azure endpoint at the same time
+MAX_CONCURRENT_REQUESTS = 16
+
+# On-disk cache of raw Azure answers, keyed by the SHA-256 of the endpoint and the HTML batch
+AZURE_CACHE_FILE = ".azure_cache"
+
 
 def allowSelfSignedHttps(allowed):
     if allowed and not os.environ.get('PYTHONHTTPSVERIFY', '') and getattr(ssl, '_create_unverified_context', None):
@@ -29,64 +46,205 @@ allowSelfSignedHttps(True)
 
 
 def fetch_html(url):
-    """Fetch full HTML from the provided URL."""
+    """Fetch full HTML from the provided URL as raw bytes, together with its character encoding."""
     response = requests.get(url)
     response.raise_for_status()
-    return response.text
+    return response.content, response_encoding(response)
 
 
-def remove_script_tags(soup):
-    """Remove all <script> tags from the BeautifulSoup object."""
-    for script in soup.find_all('script'):
-        script.decompose()
-    return soup
+def response_encoding(response):
+    """Charset from the Content-Type header, else UTF-8 if the body decodes as UTF-8, else None (use <meta charset>)."""
+    if "charset=" in response.headers.get("Content-Type", "").lower():
+        return response.encoding
+    try:
+        response.content.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+    return "utf-8"
 
 
-def count_tokens(text):
-    return len(text.split())
+def remove_script_tags(root):
+    """Remove all <script> tags inside the lxml element, keeping the text that follows them."""
+    etree.strip_elements(root, 'script', with_tail=False)
+    return root
 
 
-def batch_html_by_tokens(html, token_limit=1000):
-    """Splits HTML into logical parts ensuring each batch fits within the token limit."""
-    soup = BeautifulSoup(html, 'html.parser')
-    soup = remove_script_tags(soup)
+@functools.lru_cache(maxsize=None)
+def get_token_encoding():
+    """Loads the BPE tokenizer used to measure batches in model tokens on first use."""
+    return tiktoken.get_encoding("cl100k_base")
 
-    body = soup.body if soup.body else soup
-    batches = []
-    current_batch = ""
 
-    for element in body.children:
-        elem_str = str(element).strip()
+def count_tokens(text):
+    return len(get_token_encoding().encode(text, disallowed_special=()))
+
+
+def iter_body_children(html, encoding=None):
+    """Incrementally parses HTML bytes and yields each child of <body> and its loose text, dropping them afterwards."""
+    if not html.strip():
+        return  # lxml cannot parse an empty document, and there is nothing to batch
+    body = None
+    body_text_done = False
+    pending = None
+    events = ('start', 'end', 'comment')
+    for event, element in etree.iterparse(io.BytesIO(html), events=events, html=True, encoding=encoding):
+        if body is None:
+            if event == 'start' and element.tag == 'body':
+                body = element
+            elif event == 'end' and element.tag == 'head':
+                element.clear()
+            continue
+        if element is not body and element.getparent() is not body:
+            continue
+
+        # The text before a new child, comment or the end of the body has been parsed completely
+        if event != 'end' or element is body:
+            if not body_text_done:
+                body_text_done = True
+                if body.text and body.text.strip():
+                    yield body.text
+            if pending is not None:
+                if pending.tag == 'script' or pending.tag is etree.Comment:
+                    if pending.tail and pending.tail.strip():
+                        yield pending.tail
+                else:
+                    yield remove_script_tags(pending)
+                body.remove(pending)
+                pending = None
+        if event != 'start' and element is not body:
+            pending = element
+
+
+def wrap_batch(batch):
+    """Wraps a batch of body elements in a minimal HTML document."""
+    return f"<html><head></head><body>{batch}</body></html>"
+
+
+def split_text_by_tokens(text, token_limit):
+    """Cuts text into consecutive pieces of at most token_limit tokens that each decode cleanly."""
+    encoding = get_token_encoding()
+    tokens = encoding.encode(text, disallowed_special=())
+    data = text.encode("utf-8")
+    ends = list(accumulate(map(len, encoding.decode_tokens_bytes(tokens))))
+    start = 0
+    while start < len(tokens):
+        stop = min(start + token_limit, len(tokens))
+        if stop < len(tokens):
+            stop = clean_token_cut(data, ends, start, stop)
+        yield data[ends[start - 1] if start else 0:ends[stop - 1]].decode("utf-8", errors="replace")
+        start = stop
+
+
+def clean_token_cut(data, ends, start, stop):
+    """Returns the last token index up to stop that ends between two characters, preferably outside markup."""
+    begin = ends[start - 1] if start else 0
+    piece = data[begin:ends[stop - 1]]
+    markup_start = ends[stop - 1]
+    for opener, closer in ((b"<", b">"), (b"&", b";")):
+        position = piece.rfind(opener)
+        if position > piece.rfind(closer):
+            markup_start = min(markup_start, begin + position)
+
+    char_cut = None
+    for cut in range(stop, start, -1):
+        end = ends[cut - 1]
+        if end < len(data) and data[end] & 0xC0 == 0x80:
+            continue
+        if end <= markup_start:
+            return cut
+        if char_cut is None:
+            char_cut = cut
+    if char_cut is not None:
+        return char_cut
+    # No character ends inside the window, so finish the one it stops in
+    cut = stop
+    while cut < len(ends) and data[ends[cut - 1]] & 0xC0 == 0x80:
+        cut += 1
+    return cut
+
+
+def element_tags(element):
+    """Returns the start and end tag of an element as HTML, or None for comments and tags lxml cannot rebuild."""
+    if not isinstance(element.tag, str):
+        return None
+    try:
+        shell = element.makeelement(element.tag, element.attrib)
+    except ValueError:
+        return None
+    start_tag = etree.tostring(shell, encoding='unicode', method='html')
+    end_tag = f"</{element.tag}>"
+    if not start_tag.endswith(end_tag):
+        return start_tag, ""
+    return start_tag[:-len(end_tag)], end_tag
+
+
+def batch_elements_by_tokens(elements, token_limit):
+    """Groups elements and text pieces into batches within the token limit, recursing into oversized elements."""
+    current_parts = []
+    current_tokens = 0
+
+    for element in elements:
+        if isinstance(element, str):
+            elem_str = escape(element, quote=False).strip()
+        else:
+            elem_str = etree.tostring(element, encoding='unicode', method='html').strip()
         if not elem_str:
             continue
         tokens_in_elem = count_tokens(elem_str)
 
         if tokens_in_elem > token_limit:
-            if current_batch:
-                batches.append(current_batch)
-                current_batch = ""
-            batches.append(elem_str)
+            if current_parts:
+                yield "\n".join(current_parts)
+                current_parts = []
+                current_tokens = 0
+            tags = None if isinstance(element, str) else element_tags(element)
+            content = [] if tags is None else ([element.text] if element.text else []) + list(element)
+            content_limit = token_limit - count_tokens("".join(tags)) if tags else 0
+            if not content or content_limit < 1:
+                yield from split_text_by_tokens(elem_str, token_limit)
+                continue
+
+            # Every sub-batch keeps the element's own tags and attributes
+            start_tag, end_tag = tags
+            for sub_batch in batch_elements_by_tokens(content, content_limit):
+                yield start_tag + sub_batch + end_tag
+
+            elem_str = escape(element.tail or "", quote=False).strip()
+            if not elem_str:
+                continue
+            tokens_in_elem = count_tokens(elem_str)
+            if tokens_in_elem > token_limit:
+                yield from split_text_by_tokens(elem_str, token_limit)
+                continue
+
+        if current_tokens + tokens_in_elem <= token_limit:
+            current_parts.append(elem_str)
+            current_tokens += tokens_in_elem
         else:
-            current_tokens = count_tokens(current_batch)
-            if current_tokens + tokens_in_elem <= token_limit:
-                current_batch += "\n" + elem_str
-            else:
-                batches.append(current_batch)
-                current_batch = elem_str
+            yield "\n".join(current_parts)
+            current_parts = [elem_str]
+            current_tokens = tokens_in_elem
+
+    if current_parts:
+        yield "\n".join(current_parts)
 
-    if current_batch:
-        batches.append(current_batch)
 
-    wrapped_batches = [f"<html><head></head><body>{batch}</body></html>" for batch in batches]
-    return wrapped_batches
+def batch_html_by_tokens(html, token_limit=1000, encoding=None):
+    """Splits HTML into logical parts within the token limit, yielding each batch as soon as it is full."""
+    for batch in batch_elements_by_tokens(iter_body_children(html, encoding), token_limit):
+        yield wrap_batch(batch)
 
 
-def send_to_azure_model(batch):
-    """Sends HTML batch to Azure AI Foundry model."""
-    payload = json.dumps({
+async def send_to_azure_model_async(session, semaphore, cache, batch):
+    """Sends HTML batch to Azure AI Foundry model, answering batches already sent to this endpoint from the cache."""
+    key = hashlib.sha256(f"{AZURE_MODEL_ENDPOINT}\n{batch}".encode("utf-8")).hexdigest()
+    if key in cache:
+        return cache[key]
+
+    payload = orjson.dumps({
         "html_string": batch,
         "chat_history": [{}]
-    }).encode("utf-8")
+    })
 
     headers = {
         'Content-Type': 'application/json',
@@ -94,15 +252,64 @@ def send_to_azure_model(batch):
         'Authorization': f'Bearer {AZURE_API_KEY}'
     }
 
-    req = urllib.request.Request(AZURE_MODEL_ENDPOINT, data=payload, headers=headers)
+    async with semaphore:
+        async with session.post(AZURE_MODEL_ENDPOINT, data=payload, headers=headers) as response:
+            if not response.ok:
+                print("Request failed with status code:", response.status)
+                return ""
+            result_json = orjson.loads(await response.read())
+
+    answer = result_json.get("answer", "")
+    cache[key] = answer
+    return answer
+
+
+async def send_batches_to_azure(batches):
+    """Sends HTML batches to Azure as a worker thread builds them, returning the answers in batch order."""
+    loop = asyncio.get_running_loop()
+    batches = iter(batches)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    # aiohttp does not use ssl's default HTTPS context, so pass it explicitly to honour allowSelfSignedHttps
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_REQUESTS, ssl=ssl._create_default_https_context())
+    with ThreadPoolExecutor(max_workers=1) as builder, shelve.open(AZURE_CACHE_FILE) as cache:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            tasks = []
+            try:
+                while (batch := await loop.run_in_executor(builder, next, batches, None)) is not None:
+                    tasks.append(asyncio.create_task(send_to_azure_model_async(session, semaphore, cache, batch)))
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+            return await asyncio.gather(*tasks)
+
+
+def strip_ruby_fences(answer):
+    """Removes the markdown Ruby fences around an Azure answer, if present."""
+    if answer.startswith("```ruby") and answer.rstrip().endswith("```"):
+        lines = answer.splitlines()
+        answer = "\n".join(lines[1:-1])
+    return answer
+
+
+def beautify_ruby_with_rufo(ruby_code):
+    """Formats Ruby code with the local rufo formatter. Returns None if rufo is missing or fails."""
+    if shutil.which("rufo") is None:
+        return None
+
+    fd, path = tempfile.mkstemp(suffix=".rb")
     try:
-        response = urllib.request.urlopen(req)
-        result = response.read()
-        result_json = json.loads(result)
-        return result_json.get("answer", "")
-    except urllib.error.HTTPError as error:
-        print("Request failed with status code:", error.code)
-        return ""
+        with open(fd, "w", encoding="utf-8") as tmp:
+            tmp.write(ruby_code)
+        # rufo exits with 0 when the file was already formatted and 3 when it rewrote it
+        result = subprocess.run(["rufo", path], capture_output=True)
+        if result.returncode not in (0, 3):
+            return None
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+    finally:
+        os.remove(path)
 
 
 def beautify_ruby_with_openai(ruby_code):
@@ -126,22 +333,23 @@ def main():
     url = input("Enter the URL: ").strip()
 
     try:
-        html = fetch_html(url)
+        html, encoding = fetch_html(url)
     except Exception as e:
         print(f"Failed to fetch HTML: {e}")
         return
 
-    batches = batch_html_by_tokens(html, token_limit=1000)
-    print(f"Total batches created: {len(batches)}")
-
-    combined_pageobject = ""
-    for idx, batch in enumerate(batches, start=1):
-        print(f"Processing batch {idx}/{len(batches)}...")
-        pageobject = send_to_azure_model(batch)
-        combined_pageobject += pageobject + "\n"
-
-    print("Sending combined Ruby code to OpenAI for beautification...")
-    beautified_ruby = beautify_ruby_with_openai(combined_pageobject)
+    batches = batch_html_by_tokens(html, token_limit=1000, encoding=encoding)
+    print("Processing batches concurrently as they are created...")
+    pageobjects = asyncio.run(send_batches_to_azure(batches))
+    print(f"Total batches processed: {len(pageobjects)}")
+    combined_pageobject = "".join(pageobject + "\n" for pageobject in pageobjects)
+
+    # rufo needs plain Ruby; the raw answers are kept for the OpenAI fallback
+    ruby_code = "".join(strip_ruby_fences(pageobject) + "\n" for pageobject in pageobjects)
+    beautified_ruby = beautify_ruby_with_rufo(ruby_code)
+    if beautified_ruby is None:
+        print("Sending combined Ruby code to OpenAI for beautification...")
+        beautified_ruby = beautify_ruby_with_openai(combined_pageobject)
 
     beautified_output = "beautified_pageobject.rb"
     with open(beautified_output, "w", encoding="utf-8") as f:
@@ -1,12 +1,21 @@
+import asyncio
+import aiohttp
+import functools
+import hashlib
+import orjson
+import shelve
 import requests
-from bs4 import BeautifulSoup
-import urllib.request
-import urllib.error
-import json
+import tiktoken
+import io
+from concurrent.futures import ThreadPoolExecutor
+from html import escape
+import mmap
+from lxml import etree
 import os
 import ssl
 from dotenv import load_dotenv
 import re
+from itertools import accumulate, islice
 
 # Load environment variables from .env file
 load_dotenv()
@@ -16,6 +25,13 @@ AZURE_API_KEY = os.getenv("AZURE_API_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 AZURE_MODEL_ENDPOINT = os.getenv("AZURE_MODEL_ENDPOINT")
 
+# Maximum number of batches sent to the Azure endpoint at the same time
+MAX_CONCURRENT_REQUESTS = 16
+
+# On-disk cache of raw Azure answers, keyed by the SHA-256 of the endpoint and the HTML batch
+AZURE_CACHE_FILE = ".azure_cache"
+
+
 def allowSelfSignedHttps(allowed):
     # Bypass the server certificate verification on client side if needed
     if allowed and not os.environ.get('PYTHONHTTPSVERIFY', '') and getattr(ssl, '_create_unverified_context', None):
@@ -27,105 +43,353 @@ allowSelfSignedHttps(True)
 
 
 def fetch_html(url):
-    """Fetch full HTML from the provided URL."""
+    """
+    Fetch full HTML from the provided URL as raw bytes, together with its character encoding
+    (see response_encoding) so the parser decodes the page the way the server declared it.
+    """
     response = requests.get(url)
     response.raise_for_status()
-    return response.text
+    return response.content, response_encoding(response)
+
+
+def response_encoding(response):
+    """
+    Returns the charset declared in the Content-Type header. Without one, returns "utf-8" if the
+    body is valid UTF-8, and otherwise None so the parser falls back to the page's <meta charset>.
+    """
+    if "charset=" in response.headers.get("Content-Type", "").lower():
+        return response.encoding
+    try:
+        response.content.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+    return "utf-8"
+
 
+def remove_script_tags(root):
+    """Remove all <script> tags inside the lxml element, keeping the text that follows them."""
+    etree.strip_elements(root, 'script', with_tail=False)
+    return root
 
-def remove_script_tags(soup):
-    """Remove all <script> tags from the BeautifulSoup object."""
-    for script in soup.find_all('script'):
-        script.decompose()
-    return soup
+
+@functools.lru_cache(maxsize=None)
+def get_token_encoding():
+    """
+    Returns the BPE tokenizer used to measure batch sizes in real model tokens.
+    It is loaded on first use rather than at import, because tiktoken downloads the
+    vocabulary the first time; code that only beautifies Ruby never needs it.
+    """
+    return tiktoken.get_encoding("cl100k_base")
 
 
 def count_tokens(text):
     """
-    A simple token counter using whitespace split.
-    In a real scenario, you may want to use the tokenizer used by your model.
+    Counts model tokens with the BPE tokenizer (tiktoken) so batches are packed to the real limit.
+    Special-token text such as "<|endoftext|>" found in a page is counted as ordinary text.
     """
-    return len(text.split())
+    return len(get_token_encoding().encode(text, disallowed_special=()))
 
 
-def batch_html_by_tokens(html, token_limit=1000):
+def iter_body_children(html, encoding=None):
     """
-    Splits the HTML into logical batches without cutting HTML tags.
-    It parses the HTML, removes <script> tags, and groups children of the <body>
-    until the token limit is reached. Each batch is then wrapped with minimal HTML.
+    Parses the raw HTML bytes incrementally (lxml iterparse, decoding them with encoding if given)
+    and yields the direct children of <body> one at a time, with their <script> tags removed.
+    Text directly inside <body> before its first child is yielded as a plain string.
+    A child is yielded once it and the text following it are complete, then dropped from the
+    tree, so memory stays proportional to the largest child rather than the whole document.
+    Top-level <script> elements and comments are skipped, but the text right after them is
+    yielded as a plain string.
+    """
+    if not html.strip():
+        return  # lxml cannot parse an empty document, and there is nothing to batch
+    body = None
+    body_text_done = False
+    pending = None  # last complete child of <body>, held back until its tail text is parsed
+    events = ('start', 'end', 'comment')
+    for event, element in etree.iterparse(io.BytesIO(html), events=events, html=True, encoding=encoding):
+        if body is None:
+            if event == 'start' and element.tag == 'body':
+                body = element
+            elif event == 'end' and element.tag == 'head':
+                element.clear()  # nothing in <head> is batched
+            continue
+        if element is not body and element.getparent() is not body:
+            continue  # nested deeper, handled as part of its body-level ancestor
+
+        # A new child or comment starts or the body ends, so the text before it is complete
+        if event != 'end' or element is body:
+            if not body_text_done:
+                body_text_done = True
+                if body.text and body.text.strip():
+                    yield body.text
+            if pending is not None:
+                if pending.tag == 'script' or pending.tag is etree.Comment:
+                    if pending.tail and pending.tail.strip():
+                        yield pending.tail
+                else:
+                    yield remove_script_tags(pending)
+                body.remove(pending)
+                pending = None
+        if event != 'start' and element is not body:
+            pending = element
+
+
+def wrap_batch(batch):
+    """Wraps a batch in minimal HTML structure to ensure it's runnable."""
+    return f"<html><head></head><body>{batch}</body></html>"
+
+
+def split_text_by_tokens(text, token_limit):
+    """
+    Cuts text into consecutive pieces of at most token_limit tokens.
+    Pieces end on a token boundary between two characters and, where possible, outside any tag
+    or character reference, so each one decodes cleanly; see clean_token_cut.
+    Used as a last resort for text, or an element without content, that exceeds the limit.
+    """
+    encoding = get_token_encoding()
+    tokens = encoding.encode(text, disallowed_special=())
+    data = text.encode("utf-8")
+    # Byte offset in data at which each token ends
+    ends = list(accumulate(map(len, encoding.decode_tokens_bytes(tokens))))
+    start = 0
+    while start < len(tokens):
+        stop = min(start + token_limit, len(tokens))
+        if stop < len(tokens):
+            stop = clean_token_cut(data, ends, start, stop)
+        yield data[ends[start - 1] if start else 0:ends[stop - 1]].decode("utf-8", errors="replace")
+        start = stop
+
+
+def clean_token_cut(data, ends, start, stop):
+    """
+    Returns the last token index in (start, stop] after which the UTF-8 bytes in data can be cut:
+    between two characters, and not after a "<" or "&" that is left open within the piece.
+    If no such cut exists, the last cut between two characters is used, so only a tag or
+    reference longer than the limit is cut through. If not even one character ends in the
+    window, the cut moves past stop to the end of that character, which never splits it.
+    """
+    begin = ends[start - 1] if start else 0
+    piece = data[begin:ends[stop - 1]]
+    markup_start = ends[stop - 1]
+    for opener, closer in ((b"<", b">"), (b"&", b";")):
+        position = piece.rfind(opener)
+        if position > piece.rfind(closer):
+            markup_start = min(markup_start, begin + position)
+
+    char_cut = None
+    for cut in range(stop, start, -1):
+        end = ends[cut - 1]
+        if end < len(data) and data[end] & 0xC0 == 0x80:
+            continue  # the next byte continues a multi-byte character
+        if end <= markup_start:
+            return cut
+        if char_cut is None:
+            char_cut = cut
+    if char_cut is not None:
+        return char_cut
+    cut = stop
+    while cut < len(ends) and data[ends[cut - 1]] & 0xC0 == 0x80:
+        cut += 1
+    return cut
+
+
+def element_tags(element):
     """
-    soup = BeautifulSoup(html, 'html.parser')
-    soup = remove_script_tags(soup)  # Remove <script> tags
+    Returns the start and end tag of an lxml element as HTML strings, attributes included.
+    Void elements such as <img> get an empty end tag. Returns None for comments and for
+    tag names the HTML parser accepts but lxml cannot rebuild, such as "svg:path".
+    """
+    if not isinstance(element.tag, str):
+        return None
+    try:
+        shell = element.makeelement(element.tag, element.attrib)
+    except ValueError:
+        return None
+    start_tag = etree.tostring(shell, encoding='unicode', method='html')
+    end_tag = f"</{element.tag}>"
+    if not start_tag.endswith(end_tag):
+        return start_tag, ""
+    return start_tag[:-len(end_tag)], end_tag
 
-    body = soup.body if soup.body else soup
-    batches = []
-    current_batch = ""
 
-    # Iterate over the direct children of the body
-    for element in body.children:
-        elem_str = str(element).strip()
+def batch_elements_by_tokens(elements, token_limit):
+    """
+    Groups lxml elements and plain text pieces into batches of serialized HTML that fit within
+    the token limit.
+    An element that is larger than the limit on its own is split up: its text and children are
+    batched recursively, each sub-batch wrapped in the element's own start and end tag, and the
+    text after it is batched as a text piece. Text, and an element without content, is cut into
+    token-sized pieces.
+    This is a generator: every batch is yielded as soon as it is full.
+    """
+    current_parts = []
+    current_tokens = 0
+
+    for element in elements:
+        # Serialized once, including the text that follows the element; text pieces are escaped
+        if isinstance(element, str):
+            elem_str = escape(element, quote=False).strip()
+        else:
+            elem_str = etree.tostring(element, encoding='unicode', method='html').strip()
         if not elem_str:
             continue  # Skip empty strings or whitespace
         tokens_in_elem = count_tokens(elem_str)
 
-        # If the element itself is larger than the token limit,
-        # add it as a separate batch even if it exceeds the limit.
+        # If the element itself is larger than the token limit, flush the current batch
+        # and split the element up so that no batch exceeds the limit.
         if tokens_in_elem > token_limit:
-            if current_batch:
-                batches.append(current_batch)
-                current_batch = ""
-            batches.append(elem_str)
+            if current_parts:
+                yield "\n".join(current_parts)
+                current_parts = []
+                current_tokens = 0
+            tags = None if isinstance(element, str) else element_tags(element)
+            content = [] if tags is None else ([element.text] if element.text else []) + list(element)
+            content_limit = token_limit - count_tokens("".join(tags)) if tags else 0
+            if not content or content_limit < 1:
+                yield from split_text_by_tokens(elem_str, token_limit)
+                continue
+
+            # Repeat the element's tags around every sub-batch so none loses the element or its attributes
+            start_tag, end_tag = tags
+            for sub_batch in batch_elements_by_tokens(content, content_limit):
+                yield start_tag + sub_batch + end_tag
+
+            # The text after the element goes on like a text piece
+            elem_str = escape(element.tail or "", quote=False).strip()
+            if not elem_str:
+                continue
+            tokens_in_elem = count_tokens(elem_str)
+            if tokens_in_elem > token_limit:
+                yield from split_text_by_tokens(elem_str, token_limit)
+                continue
+
+        if current_tokens + tokens_in_elem <= token_limit:
+            current_parts.append(elem_str)
+            current_tokens += tokens_in_elem
         else:
-            current_tokens = count_tokens(current_batch)
-            if current_tokens + tokens_in_elem <= token_limit:
-                current_batch += "\n" + elem_str
-            else:
-                batches.append(current_batch)
-                current_batch = elem_str
+            yield "\n".join(current_parts)
+            current_parts = [elem_str]
+            current_tokens = tokens_in_elem
 
-    if current_batch:
-        batches.append(current_batch)
+    if current_parts:
+        yield "\n".join(current_parts)
 
-    # Wrap each batch in minimal HTML structure to ensure it's runnable
-    wrapped_batches = []
-    for batch in batches:
-        wrapped = f"<html><head></head><body>{batch}</body></html>"
-        wrapped_batches.append(wrapped)
 
-    return wrapped_batches
+def batch_html_by_tokens(html, token_limit=1000, encoding=None):
+    """
+    Splits the HTML into logical batches without cutting HTML tags where possible.
+    It parses the raw HTML bytes as a stream, removes <script> tags, and groups children of the <body>
+    until the token limit is reached. Each batch is then wrapped with minimal HTML.
+    This is a generator: every batch is yielded as soon as it is full, so it can be sent
+    while the following batches are still being built.
+    """
+    # Iterate over the direct children of the body, as they are parsed
+    for batch in batch_elements_by_tokens(iter_body_children(html, encoding), token_limit):
+        yield wrap_batch(batch)
 
 
-def send_to_azure_model(batch, model_endpoint, api_key):
+async def send_to_azure_model_async(session, semaphore, cache, batch, model_endpoint, api_key):
     """
-    Sends a batch of HTML to the Azure AI Foundry prompt flow model using urllib.request.
+    Sends a batch of HTML to the Azure AI Foundry prompt flow model using the shared aiohttp session.
     The payload includes the required fields 'html_string' and 'chat_history'.
     Expects the response JSON to contain an 'answer' field with markdown‑formatted Ruby code.
+    The semaphore caps how many requests are in flight at once.
+    Batches already answered by this endpoint (in this or an earlier run) are served from the cache
+    without a request. The cache holds the raw answer, so it can be shared with AiVersion.py.
     """
-    payload = json.dumps({
-        "html_string": batch,
-        "chat_history": [{}]
-    }).encode("utf-8")
-    headers = {
-        'Content-Type': 'application/json',
-        'Accept': 'application/json',
-        'Authorization': 'Bearer ' + api_key
-    }
-    req = urllib.request.Request(model_endpoint, data=payload, headers=headers)
-    try:
-        response = urllib.request.urlopen(req)
-        result = response.read()
-        result_json = json.loads(result)
+    key = hashlib.sha256(f"{model_endpoint}\n{batch}".encode("utf-8")).hexdigest()
+    if key in cache:
+        answer = cache[key]
+    else:
+        payload = orjson.dumps({
+            "html_string": batch,
+            "chat_history": [{}]
+        })
+        headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'Authorization': 'Bearer ' + api_key
+        }
+        async with semaphore:
+            async with session.post(model_endpoint, data=payload, headers=headers) as response:
+                if not response.ok:
+                    print("The request failed with status code: " + str(response.status))
+                    print(response.headers)
+                    print(await response.text(errors='ignore'))
+                    return ""
+                result_json = orjson.loads(await response.read())
         answer = result_json.get("answer", "")
-        # Remove markdown Ruby fences if present.
-        if answer.startswith("ruby") and answer.rstrip().endswith(""):
-            lines = answer.splitlines()
-            answer = "\n".join(lines[1:-1])
-        return answer
-    except urllib.error.HTTPError as error:
-        print("The request failed with status code: " + str(error.code))
-        print(error.info())
-        print(error.read().decode("utf8", 'ignore'))
-        return ""
+        cache[key] = answer
+
+    # Remove markdown Ruby fences if present.
+    if answer.startswith("ruby") and answer.rstrip().endswith(""):
+        lines = answer.splitlines()
+        answer = "\n".join(lines[1:-1])
+    return answer
+
+
+async def send_batches_to_azure(batches, model_endpoint, api_key):
+    """
+    Sends batches to the Azure model concurrently over one aiohttp session,
+    with answers cached on disk in AZURE_CACHE_FILE.
+    The batches are built in a worker thread, and each request is started as soon as
+    its batch is produced, so parsing and tokenizing the rest of the page runs while
+    earlier requests wait on the network. The answers keep the batch order.
+    """
+    loop = asyncio.get_running_loop()
+    batches = iter(batches)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    # aiohttp does not use ssl's default HTTPS context, so pass it explicitly to honour allowSelfSignedHttps
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_REQUESTS, ssl=ssl._create_default_https_context())
+    # A single worker keeps the lxml parser behind the batch generator on one thread
+    with ThreadPoolExecutor(max_workers=1) as builder, shelve.open(AZURE_CACHE_FILE) as cache:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            tasks = []
+            try:
+                while (batch := await loop.run_in_executor(builder, next, batches, None)) is not None:
+                    tasks.append(asyncio.create_task(
+                        send_to_azure_model_async(session, semaphore, cache, batch, model_endpoint, api_key)
+                    ))
+            except BaseException:
+                # Building a batch failed: stop the requests already started before the session closes
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+            return await asyncio.gather(*tasks)
+
+
+# PageObject accessor methods that declare elements on a page, e.g. text_field(:username, id: 'user')
+ACCESSOR_KEYWORDS = frozenset({
+    'text_field', 'hidden_field', 'button', 'link', 'select_list', 'checkbox',
+    'radio_button', 'radio_button_group', 'textarea', 'div', 'span', 'table',
+    'cell', 'image', 'element', 'heading', 'paragraph'
+})
+
+# Classifies a line of generated Ruby in a single match; the matched group name
+# (match.lastgroup) tells what kind of line it is:
+#   cls  - "class X" opening a class block
+#   end  - a bare "end"
+#   inc  - "include PageObject"
+#   def  - a method definition, with the method name in the "name" group
+#   call - a call such as text_field( ... ), with the called name in the "callee" group;
+#          it is an accessor when the callee is one of ACCESSOR_KEYWORDS
+# Matching any callee and checking it against the set avoids trying every keyword
+# of a large alternation on each line.
+LINE_RE = re.compile(
+    r'^\s*(?:'
+    r'(?P<cls>class\s+\S+)'
+    r'|(?P<end>end)\s*$'
+    r'|(?P<inc>include\s+PageObject)\s*$'
+    r'|(?P<def>def\s+(?P<name>[a-zA-Z0-9_!?]+))'
+    r'|(?P<call>(?P<callee>\w+)\s*\()'
+    r')'
+)
+
+# First characters a line can start with (after indentation) to be a class, end, include,
+# def or accessor line. Any other line skips LINE_RE entirely; it can only be a
+# method body line or leftover.
+LINE_INITIALS = frozenset("ceid") | frozenset(keyword[0] for keyword in ACCESSOR_KEYWORDS)
 
 
 def beautify_ruby_class(combined_code: str, site_name: str) -> str:
@@ -133,94 +397,35 @@ def beautify_ruby_class(combined_code: str, site_name: str) -> str:
     Merges multiple Ruby 'class MyPage ... end' snippets into one Ruby class named site_name.
 
     Steps:
-      1. Parse out all lines inside each class block, flattening them (ignoring the actual 'class'/'end' lines).
-      2. From those lines, extract:
+      1. Walk the lines inside each class block once (ignoring the actual 'class'/'end' lines) and extract:
          a) One 'include PageObject' (if any present).
          b) All accessors (e.g. text_field(...), button(...), link(...)) with no duplicates.
          c) All method definitions (def ... end), merging duplicates by method name.
             - Keep the first method's signature, append subsequent bodies to that method.
          d) Anything else is leftover lines appended at the bottom.
-      3. Construct a single class definition named site_name.
+      2. Construct a single class definition named site_name.
     """
 
-    # Normalize line endings
-    code = combined_code.replace("\r\n", "\n").replace("\r", "\n")
-    lines = code.split("\n")
+    # Split on "\r\n", "\r" and "\n" line endings in a single pass. str.splitlines() is not used
+    # because it also breaks lines on form feeds and Unicode separators inside string literals.
+    lines = re.split(r'\r\n|\r|\n', combined_code)
 
     # -------------------------------------------------------------------------
-    # 1) Flatten all lines in class blocks, ignoring "class X" and the matching "end".
+    # 1) Walk the lines once. Each line is classified with LINE_RE and routed
+    #    straight into its bucket:
+    #      - "class X" lines and the "end" closing a class block are skipped,
+    #      - a single "include PageObject" is remembered,
+    #      - accessors are kept in order, skipping duplicates,
+    #      - lines from "def <method_name>" up to the matching "end" are stored by
+    #        method_name. If we see multiple definitions with the same method_name,
+    #        we unify them below: keep the first def ... line and last end,
+    #        but merge all internal lines,
+    #      - anything else is leftover.
+    #    Lines outside class blocks are only used if no class is recognized at all.
     # -------------------------------------------------------------------------
-    in_class = 0
-    flattened_lines = []
-    for line in lines:
-        stripped = line.strip()
-        if stripped.startswith("class "):
-            # Start of a class block
-            in_class += 1
-            continue  # skip writing "class ..."
-        elif stripped == "end":
-            if in_class > 0:
-                in_class -= 1
-                continue  # skip writing the 'end'
-        else:
-            if in_class > 0:
-                flattened_lines.append(line)  # keep the line if we are inside a class
-
-    # If no classes recognized, fallback to entire file
-    if not flattened_lines:
-        flattened_lines = lines[:]
-
-    # -------------------------------------------------------------------------
-    # 2) Extract a single include PageObject (if present).
-    # -------------------------------------------------------------------------
-    includes_found = []
-    tmp_after_includes = []
-    include_re = re.compile(r'^\s*include\s+PageObject\s*$')
-    for line in flattened_lines:
-        if include_re.match(line.strip()):
-            includes_found.append(line.strip())
-        else:
-            tmp_after_includes.append(line)
-    flattened_lines = tmp_after_includes
-    found_include_pageobject = (len(includes_found) > 0)
-
-    # -------------------------------------------------------------------------
-    # 3) Extract accessors. We'll define a pattern for lines that begin with:
-    #    text_field, hidden_field, button, link, element, etc.
-    #    We keep them in order, but skip duplicates.
-    # -------------------------------------------------------------------------
-    accessor_keywords = [
-        'text_field', 'hidden_field', 'button', 'link', 'select_list', 'checkbox',
-        'radio_button', 'radio_button_group', 'textarea', 'div', 'span', 'table',
-        'cell', 'image', 'element', 'heading', 'paragraph'
-    ]
-    # A line that *begins* with something like text_field( (allowing whitespace).
-    accessor_pattern = re.compile(r'^\s*(?:' + "|".join(accessor_keywords) + r')\s*\(')
-
+    found_include_pageobject = False
     accessors = []
     seen_accessors = set()
-    lines_after_accessors = []
-    for line in flattened_lines:
-        if accessor_pattern.match(line.strip()):
-            # It's an accessor line
-            norm = line.strip()
-            if norm not in seen_accessors:
-                seen_accessors.add(norm)
-                accessors.append(norm)
-        else:
-            lines_after_accessors.append(line)
-
-    # -------------------------------------------------------------------------
-    # 4) Extract method definitions from lines_after_accessors.
-    #    We want to gather lines from "def <method_name>" up to the matching "end".
-    #    We'll store them by method_name. If we see multiple definitions with the
-    #    same method_name, we unify them: keep the first def ... line and last end,
-    #    but merge all internal lines.
-    # -------------------------------------------------------------------------
-    def_pattern = re.compile(r'^\s*def\s+([a-zA-Z0-9_!?]+)')
-    end_pattern = re.compile(r'^\s*end\s*$')
-
-    # We will parse in one pass, building method blocks or leaving leftover lines alone.
     methods_extracted = {}  # {method_name -> list of [list_of_lines_for_this_definition, ...]}
     leftover = []
     in_method = False
@@ -237,72 +442,80 @@ def beautify_ruby_class(combined_code: str, site_name: str) -> str:
         current_method_name = None
         current_method_lines = []
 
-    for line in lines_after_accessors:
-        # Check if this line starts a method
-        start_match = def_pattern.match(line)
-        if start_match and not in_method:
-            # We are beginning a new method
-            in_method = True
-            # flush any partial
-            flush_method()
-            current_method_name = start_match.group(1)
-            current_method_lines = [line]
+    def route(line, match):
+        """Put a line from a class body into the include/accessor/method/leftover buckets."""
+        nonlocal found_include_pageobject, in_method, current_method_name, current_method_lines
+        kind = match.lastgroup if match else None
+        if kind == "inc":
+            found_include_pageobject = True
+        elif kind == "call" and match.group("callee") in ACCESSOR_KEYWORDS:
+            # It's an accessor line
+            norm = line.strip()
+            if norm not in seen_accessors:
+                seen_accessors.add(norm)
+                accessors.append(norm)
         elif in_method:
-            # we're inside a method, check if this line is the 'end'
-            if end_pattern.match(line):
-                # method is closing
-                current_method_lines.append(line)
-                # store it
+            current_method_lines.append(line)
+            # the method is closing, store it
+            if kind == "end":
                 flush_method()
                 in_method = False
-            else:
-                current_method_lines.append(line)
+        elif kind == "def":
+            # We are beginning a new method
+            in_method = True
+            current_method_name = match.group("name")
+            current_method_lines = [line]
         else:
             # not in a method
             leftover.append(line)
 
-    # If code ended while we were still in a method block, flush it:
-    if in_method and current_method_lines:
-        flush_method()
-
-    # Now we unify methods that appear multiple times
-    # For each method_name, we have a list of method blocks. We'll combine them:
-    #   - Keep the first line from the *first* definition and the last "end" line from the first definition
-    #   - Insert bodies of subsequent definitions in between (minus their 'def' and 'end').
-    merged_methods = []
-    for m_name, blocks in methods_extracted.items():
-        if not blocks:
+    in_class = 0
+    found_class = False
+    outside_class = []  # (line, match) pairs seen before any class, for the fallback
+    # This loop runs once per line, so lookups are bound to locals and unclassified
+    # lines (most method bodies) are appended directly instead of going through route().
+    match_line = LINE_RE.match
+    line_initials = LINE_INITIALS
+    for line in lines:
+        stripped = line.lstrip()
+        match = match_line(stripped) if stripped[:1] in line_initials else None
+        if match is None:
+            if in_class == 0:
+                if not found_class:
+                    outside_class.append((line, None))
+            elif in_method:
+                current_method_lines.append(line)
+            else:
+                leftover.append(line)
             continue
-        # We'll start with the first block
-        first_block = blocks[0]
-        # We'll parse out the lines: first_block[0] is "def something",
-        # last_block[-1] is "end". We'll keep them, but we'll inject in the middle any additional blocks.
-
-        # lines for final unified method
-        # keep first 'def xyz'
-        final_method_lines = [first_block[0]]
-        # everything except the first and last line goes in the "body"
-        final_method_body = first_block[1:-1]
-
-        # for subsequent blocks, skip the first line "def xyz" and last line "end"
-        for other_block in blocks[1:]:
-            # we can insert a comment to separate them if desired
-            final_method_body.append("      # ----- Merged from duplicate method definition -----")
-            final_method_body.extend(other_block[1:-1])
-
-        # now close with "end" from the *first* block
-        if len(first_block) > 1:
-            final_method_lines.extend(final_method_body)
-            final_method_lines.append(first_block[-1])
+        kind = match.lastgroup
+        if kind == "cls":
+            # Start of a class block, skip writing "class ..."
+            in_class += 1
+            found_class = True
+        elif in_class == 0:
+            if not found_class:
+                outside_class.append((line, match))
+        elif kind == "end" and not in_method:
+            # The 'end' closing the class block, skip writing it
+            in_class -= 1
         else:
-            # edge case: if the method had only "def x" but no "end"
-            final_method_lines.extend(final_method_body)
-            final_method_lines.append("end")
+            route(line, match)
 
-        merged_methods.append("\n".join(final_method_lines))
+    # If no classes recognized, fallback to entire file
+    if not found_class:
+        for line, match in outside_class:
+            route(line, match)
+
+    # If code ended while we were still in a method block, close it with an "end"
+    # indented like its "def" line, then flush it:
+    if in_method and current_method_lines:
+        def_line = current_method_lines[0]
+        current_method_lines.append(def_line[:len(def_line) - len(def_line.lstrip())] + "end")
+        flush_method()
 
     # -------------------------------------------------------------------------
-    # 5) Construct the final single class
+    # 2) Construct the final single class
     # -------------------------------------------------------------------------
     final_lines = [f"class {site_name}", ""]
 
@@ -316,11 +529,26 @@ def beautify_ruby_class(combined_code: str, site_name: str) -> str:
         final_lines.append("  " + ac)
     final_lines.append("")
 
-    # Add merged methods
-    for method_def in merged_methods:
-        # indent each line
-        for line in method_def.split("\n"):
-            final_lines.append("  " + line)
+    # Add merged methods, unifying methods that appear multiple times.
+    # For each method_name, we have a list of method blocks. We'll combine them:
+    #   - Keep the first line from the *first* definition and the last "end" line from the first definition
+    #   - Insert bodies of subsequent definitions in between (minus their 'def' and 'end').
+    # Each line is indented and written straight into final_lines; islice walks the
+    # bodies in place instead of copying them into intermediate lists.
+    for blocks in methods_extracted.values():
+        first_block = blocks[0]
+        # keep first 'def xyz'
+        final_lines.append("  " + first_block[0])
+        # everything except the first and last line goes in the "body"
+        final_lines.extend("  " + line for line in islice(first_block, 1, len(first_block) - 1))
+
+        # for subsequent blocks, skip the first line "def xyz" and last line "end"
+        for other_block in islice(blocks, 1, None):
+            final_lines.append("        # ----- Merged from duplicate method definition -----")
+            final_lines.extend("  " + line for line in islice(other_block, 1, len(other_block) - 1))
+
+        # now close with "end" from the *first* block
+        final_lines.append("  " + first_block[-1])
         final_lines.append("")
 
     # Finally, leftover lines at the bottom (if they are not just empty)
@@ -345,8 +573,13 @@ def beautify_ruby_file(input_file: str, output_file: str, site_name: str) -> Non
       output_file (str): Path where the beautified Ruby code will be saved.
       site_name (str): The new class name to use.
     """
-    with open(input_file, 'r', encoding='utf-8') as f:
-        combined_code = f.read()
+    # Decode straight from a memory map of the file to avoid an extra copy of large inputs
+    with open(input_file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            combined_code = ""  # an empty file cannot be memory-mapped
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                combined_code = str(mm, 'utf-8')
 
     pretty_code = beautify_ruby_class(combined_code, site_name)
 
@@ -360,13 +593,12 @@ def main():
     url = input("Enter the URL: ").strip()
 
     try:
-        html = fetch_html(url)
+        html, encoding = fetch_html(url)
     except Exception as e:
         print(f"Failed to fetch HTML: {e}")
         return
 
-    batches = batch_html_by_tokens(html, token_limit=1000)
-    print(f"Total batches created: {len(batches)}")
+    batches = batch_html_by_tokens(html, token_limit=1000, encoding=encoding)
 
     # Set your Azure AI Foundry prompt flow model endpoint and API key
     model_endpoint = AZURE_MODEL_ENDPOINT
@@ -374,11 +606,10 @@ def main():
     if not api_key:
         raise Exception("A key should be provided to invoke the endpoint")
 
-    combined_pageobject = ""
-    for idx, batch in enumerate(batches, start=1):
-        print(f"Processing batch {idx}/{len(batches)}...")
-        pageobject = send_to_azure_model(batch, model_endpoint, api_key)
-        combined_pageobject += pageobject + "\n"
+    print("Processing batches concurrently as they are created...")
+    pageobjects = asyncio.run(send_batches_to_azure(batches, model_endpoint, api_key))
+    print(f"Total batches processed: {len(pageobjects)}")
+    combined_pageobject = "".join(pageobject + "\n" for pageobject in pageobjects)
 
     # Save the combined Ruby pageobject into a file
     combined_output = "combined_pageobject.rb"